@@ -1,18 +1,160 @@
 import streamlit as st
 import services
+import hashlib
+import io
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+BATCH_POLL_SECONDS = 15
+ANALYSIS_POLL_SECONDS = 0.5
+PREVIEW_CHARS = 3000
+READ_BLOCK_SIZE = 1 << 16
 
 def display_error(message, details=None):
+    """Render an error; callers return afterwards instead of stopping the script"""
     st.error(message)
     if details:
         with st.expander("Error Details"):
             st.code(details)
-    st.stop()
+
+def file_digest(uploaded_file):
+    """Hash the upload block by block, once per file, to key the analysis cache"""
+    key = "digest_" + uploaded_file.file_id
+    if key not in st.session_state:
+        digest = hashlib.sha256()
+        uploaded_file.seek(0)
+        for block in iter(lambda: uploaded_file.read(READ_BLOCK_SIZE), b""):
+            digest.update(block)
+        st.session_state[key] = digest.hexdigest()
+    return st.session_state[key]
+
+def iter_lines(uploaded_file):
+    """Yield the upload's lines lazily rather than decoding and splitting it all at once"""
+    uploaded_file.seek(0)
+    text_stream = io.TextIOWrapper(uploaded_file, encoding="utf-8")
+    try:
+        for line in text_stream:
+            yield line.rstrip("\r\n")
+    finally:
+        # Detach so the wrapper doesn't close the upload when it is discarded
+        text_stream.detach()
+
+class AnalysisError(Exception):
+    """Carries an error report out of analyze_data so st.cache_data doesn't store it"""
+    def __init__(self, report):
+        super().__init__(report["error"])
+        self.report = report
 
 @st.cache_data(show_spinner=False)
-def analyze_data(file_content):
-    return services.analyze_lessons(file_content)
+def analyze_data(content_hash, _lines, _on_progress=None):
+    report = services.analyze_lessons(_lines, on_progress=_on_progress)
+    if "error" in report:
+        raise AnalysisError(report)
+    return report
+
+@st.cache_resource
+def get_executor():
+    """Worker threads shared by all sessions, so analyses don't block the script thread"""
+    return ThreadPoolExecutor(max_workers=4)
+
+def progress_buffer():
+    """Return (buffers, callback) collecting the raw LLM output of each chunk as it streams in.
+
+    The callback runs on the worker thread, so it only records text; the script
+    thread renders it on each rerun.
+    """
+    buffers = {}
+    
+    def on_progress(chunk_index, delta):
+        buffers[chunk_index] = buffers.get(chunk_index, "") + delta
+    
+    return buffers, on_progress
+
+def run_fast_analysis(uploaded_file):
+    """Analyze the file on a worker thread, rerunning the script until the result is ready"""
+    file_id = uploaded_file.file_id
+    jobs = st.session_state.setdefault("analysis_jobs", {})
+    if file_id not in jobs:
+        buffers, on_progress = progress_buffer()
+        job = {"buffers": buffers, "start_time": time.time()}
+        job["future"] = get_executor().submit(
+            analyze_data, file_digest(uploaded_file), iter_lines(uploaded_file), on_progress
+        )
+        job["future"].add_done_callback(lambda future: job.update(end_time=time.time()))
+        jobs[file_id] = job
+    job = jobs[file_id]
+    
+    if not job["future"].done():
+        st.info(f"Analyzing {uploaded_file.size / 1024:.0f} KB of lessons (this may take a minute)...")
+        # Copy first, the worker thread keeps adding to the buffers
+        buffers = dict(job["buffers"])
+        if buffers:
+            text = "\n\n".join(buffers[i] for i in sorted(buffers))
+            st.code(text[-PREVIEW_CHARS:], language="json")
+        time.sleep(ANALYSIS_POLL_SECONDS)
+        st.rerun()
+    
+    error = job["future"].exception()
+    if error is not None:
+        # Forget the failed job so the next rerun can try again
+        del jobs[file_id]
+        if isinstance(error, AnalysisError):
+            return error.report
+    report = job["future"].result()
+    # The done callback may still be running when the future reports done
+    elapsed = job.get("end_time", time.time()) - job["start_time"]
+    st.success(f"Analysis completed in {elapsed:.1f} seconds")
+    return report
+
+def run_batch_analysis(uploaded_file):
+    """Submit the file to the Batch API once, then poll it from a fragment.
+
+    Returns the report once the batch has finished, or None while it is still
+    pending; poll_batch reruns the app when results arrive.
+    """
+    file_id = uploaded_file.file_id
+    batches = st.session_state.setdefault("batches", {})
+    batch_reports = st.session_state.setdefault("batch_reports", {})
+    if file_id in batch_reports:
+        report = batch_reports[file_id]
+        # Show a failure once, then allow the file to be resubmitted
+        if "error" in report:
+            del batch_reports[file_id]
+        return report
+    
+    if file_id not in batches:
+        # Files too small for the LLM are answered locally instead of waiting on a batch
+        report = services.quick_report(iter_lines(uploaded_file))
+        if report is not None:
+            return report
+        batch_id = services.analyze_lessons_batch([iter_lines(uploaded_file)])
+        batches[file_id] = {"id": batch_id, "status": "submitted"}
+    
+    poll_batch(uploaded_file)
+    return None
+
+@st.fragment(run_every=BATCH_POLL_SECONDS)
+def poll_batch(uploaded_file):
+    """Check the pending batch every BATCH_POLL_SECONDS without rerunning the whole app"""
+    file_id = uploaded_file.file_id
+    batch = st.session_state["batches"].get(file_id)
+    if batch is None:
+        return
+    
+    try:
+        status, reports = services.get_batch_results(batch["id"], [iter_lines(uploaded_file)])
+    except Exception:
+        # Fragment reruns skip main's handlers, so report here and try again next poll
+        display_error("Checking the batch status failed", traceback.format_exc())
+        return
+    if reports is not None:
+        del st.session_state["batches"][file_id]
+        st.session_state["batch_reports"][file_id] = reports[0]
+        # Results are rendered by the full script, not the fragment
+        st.rerun()
+    batch["status"] = status
+    st.info(f"Batch {batch['id']} is {batch['status']}. Results will appear here once it completes (this can take up to 24 hours).")
 
 def safe_get(dictionary, keys, default=None):
     """Safely get nested dictionary values"""
@@ -28,32 +170,45 @@ def main():
     st.title("Post-Mortem Analysis Tool")
     
     uploaded_file = st.file_uploader("Upload your file", type=["txt"])
+    fast_mode = st.toggle("Fast mode", value=True,
+                          help="Analyze immediately. Turn off to use the cheaper Batch API, which may take up to 24 hours.")
+    
+    if uploaded_file is None:
+        return
     
-    if uploaded_file is not None:
-        try:
-            file_content = uploaded_file.read().decode("utf-8").splitlines()
-            if not file_content:
-                display_error("Uploaded file is empty")
-            
-            with st.spinner("Analyzing your file (this may take a minute)..."):
-                try:
-                    start_time = time.time()
-                    report = analyze_data(file_content)
-                    st.success(f"Analysis completed in {time.time() - start_time:.1f} seconds")
-                except Exception as e:
-                    display_error("Analysis failed", traceback.format_exc())
-            
-            if "error" in report:
-                # Check if there's debug info available
-                if "debug_info" in report:
-                    display_error(f"Analysis error: {report['error']}", report['debug_info'])
-                else:
-                    display_error(f"Analysis error: {report['error']}")
-            
-            display_results(report)
-            
-        except Exception as e:
-            display_error(f"Unexpected error: {str(e)}", traceback.format_exc())
+    try:
+        if uploaded_file.size == 0:
+            display_error("Uploaded file is empty")
+            return
+        
+        if fast_mode:
+            try:
+                report = run_fast_analysis(uploaded_file)
+            except Exception:
+                display_error("Analysis failed", traceback.format_exc())
+                return
+        else:
+            try:
+                report = run_batch_analysis(uploaded_file)
+            except Exception:
+                display_error("Batch analysis failed", traceback.format_exc())
+                return
+            if report is None:
+                return
+        
+        if "error" in report:
+            # Check if there's debug info available
+            display_error(f"Analysis error: {report['error']}", report.get('debug_info'))
+            return
+        
+        display_results(report)
+        
+    except Exception as e:
+        display_error(f"Unexpected error: {str(e)}", traceback.format_exc())
+
+def bullet_list(items):
+    """Render items as one markdown list, a single element instead of one per item"""
+    return "\n".join(f"- {item}" for item in items)
 
 def display_results(report):
     tab1, tab2, tab3, tab4 = st.tabs([
@@ -66,8 +221,7 @@ def display_results(report):
     with tab1:
         st.subheader("Lines with Unrecoverable Meaning")
         if safe_get(report, ["unrecoverable_lines"]):
-            for line in report["unrecoverable_lines"]:
-                st.write(f"- {line}")
+            st.markdown(bullet_list(report["unrecoverable_lines"]))
         else:
             st.info("No unrecoverable lines found")
     
@@ -78,8 +232,10 @@ def display_results(report):
                 with st.expander(f"{safe_get(category, ['title'], 'Untitled')} (Confidence: {safe_get(category, ['overall_confidence'], '?')}%)"):
                     examples = safe_get(category, ['examples'], [])
                     if examples:
-                        for example in examples:
-                            st.write(f"- {safe_get(example, ['text'], '')} (Fit: {safe_get(example, ['confidence'], '?')}%)")
+                        st.markdown(bullet_list(
+                            f"{safe_get(example, ['text'], '')} (Fit: {safe_get(example, ['confidence'], '?')}%)"
+                            for example in examples
+                        ))
                     else:
                         st.info("No examples for this category")
         else:
@@ -88,8 +244,7 @@ def display_results(report):
     with tab3:
         st.subheader("Meaningful but Unclassified Lines")
         if safe_get(report, ["uncategorized_lines"]):
-            for line in report["uncategorized_lines"]:
-                st.write(f"- {line}")
+            st.markdown(bullet_list(report["uncategorized_lines"]))
         else:
             st.info("All meaningful lines were categorized")
     
@@ -99,15 +254,13 @@ def display_results(report):
         
         st.subheader("Key Observations")
         if safe_get(report, ["observations"]):
-            for obs in report["observations"]:
-                st.write(f"- {obs}")
+            st.markdown(bullet_list(report["observations"]))
         else:
             st.info("No observations available")
         
         st.subheader("Recommendations")
         if safe_get(report, ["recommendations"]):
-            for rec in report["recommendations"]:
-                st.write(f"- {rec}")
+            st.markdown(bullet_list(report["recommendations"]))
         else:
             st.info("No recommendations available")
 
@@ -1,11 +1,17 @@
 import openai
-import json
+import asyncio
+import hashlib
+import itertools
+import orjson
 import os
-import re
+import sqlite3
+import threading
+import time
+from collections import Counter
 import streamlit as st
 import logging
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-from openai import OpenAIError, APIConnectionError, APIError, RateLimitError, BadRequestError
+from tenacity import AsyncRetrying, stop_after_attempt, stop_after_delay, wait_random_exponential, retry_if_exception_type
+from openai import APIConnectionError, InternalServerError, RateLimitError
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -22,8 +28,10 @@ def get_api_key():
     else:
         raise ValueError("No OpenAI API key found in Streamlit secrets or environment variables")
 
-# Initialize OpenAI client
-client = openai.OpenAI(api_key=get_api_key())
+API_KEY = get_api_key()
+
+# Initialize OpenAI client (used for Batch API file and job management)
+client = openai.OpenAI(api_key=API_KEY)
 
 # Get model from Streamlit secrets or use default
 def get_model():
@@ -32,109 +40,318 @@ def get_model():
     elif os.getenv("OPENAI_MODEL"):
         return os.getenv("OPENAI_MODEL")
     else:
-        return "gpt-3.5-turbo"  # Default model
+        return "gpt-4o-mini"  # Default model
+
+# Larger model used to retry a chunk whose response fails validation
+def get_escalation_model():
+    if hasattr(st, 'secrets') and 'OPENAI_ESCALATION_MODEL' in st.secrets:
+        return st.secrets['OPENAI_ESCALATION_MODEL']
+    elif os.getenv("OPENAI_ESCALATION_MODEL"):
+        return os.getenv("OPENAI_ESCALATION_MODEL")
+    else:
+        return "gpt-4o"
 
 MODEL = get_model()
+MODEL_ESCALATE = get_escalation_model()
+_escalation_count = itertools.count(1)
+
+# Number of lines sent to the LLM per request, and how many requests run at once
+CHUNK_SIZE = 50
+MAX_CONCURRENCY = 4
+
+# Inputs with fewer distinct lines than this are reported as-is without calling the LLM
+MIN_LINES_FOR_LLM = 3
+
+TEMPERATURE = 0.1
+
+# Get Redis URL from Streamlit secrets or environment; unset means a local cache only
+def get_redis_url():
+    if hasattr(st, 'secrets') and 'REDIS_URL' in st.secrets:
+        return st.secrets['REDIS_URL']
+    return os.getenv("REDIS_URL")
+
+REDIS_URL = get_redis_url()
+CACHE_TTL_SECONDS = 86400
+# Keep an unreachable Redis from hanging the analysis; a timeout is just a cache miss
+REDIS_TIMEOUT_SECONDS = 2
+
+# Persistent cache of LLM responses. With REDIS_URL it is shared by every replica,
+# otherwise it is a local sqlite file shared by every session of this process.
+if REDIS_URL:
+    # Only needed when a shared cache is configured
+    import redis
+    _redis = redis.Redis.from_url(REDIS_URL, socket_timeout=REDIS_TIMEOUT_SECONDS,
+                                  socket_connect_timeout=REDIS_TIMEOUT_SECONDS)
+else:
+    _redis = None
+    CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".llm_cache.sqlite")
+    _cache_db = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+    _cache_db.execute("CREATE TABLE IF NOT EXISTS llm_cache "
+                      "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL DEFAULT 0)")
+    # Caches written before entries expired have no timestamp; theirs default to 0 and are purged below
+    if "created_at" not in [column[1] for column in _cache_db.execute("PRAGMA table_info(llm_cache)")]:
+        _cache_db.execute("ALTER TABLE llm_cache ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+    _cache_db.execute("CREATE INDEX IF NOT EXISTS llm_cache_created_at ON llm_cache (created_at)")
+    # Expire entries after CACHE_TTL_SECONDS like Redis does, so the file cannot grow forever
+    with _cache_db:
+        _cache_db.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - CACHE_TTL_SECONDS,))
+    _cache_lock = threading.Lock()
+
+def _cache_key(prompt, model=MODEL):
+    """Hash the full request body (model, messages, temperature, response format), which determines the response"""
+    body = orjson.dumps(build_chat_request(prompt, model), option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(body).hexdigest()
+
+def _chunk_key(chunk, model=MODEL):
+    """Key a chunk's partial report by the full request that produces it.
+
+    Reused when the rest of the file changes, but invalidated by any change to
+    the prompt, schema or model. Prefixed to stay apart from the raw response key.
+    """
+    return hashlib.sha256(("chunk\n" + _cache_key(create_llm_prompt(chunk), model)).encode("utf-8")).hexdigest()
+
+def _cache_get(key):
+    if _redis is not None:
+        # A cache outage should only cost a cache miss, not the analysis
+        try:
+            value = _redis.get("post-mortem:" + key)
+        except redis.RedisError as e:
+            logger.warning(f"Redis cache lookup failed: {str(e)}")
+            return None
+        return value.decode("utf-8") if value is not None else None
+    with _cache_lock:
+        row = _cache_db.execute("SELECT value FROM llm_cache WHERE key = ? AND created_at >= ?",
+                                (key, time.time() - CACHE_TTL_SECONDS)).fetchone()
+    return row[0] if row else None
+
+def _cache_set(key, value):
+    if _redis is not None:
+        try:
+            _redis.setex("post-mortem:" + key, CACHE_TTL_SECONDS, value)
+        except redis.RedisError as e:
+            logger.warning(f"Redis cache write failed: {str(e)}")
+        return
+    now = time.time()
+    with _cache_lock, _cache_db:
+        _cache_db.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - CACHE_TTL_SECONDS,))
+        _cache_db.execute("INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                          (key, value, now))
+
+def _cache_delete(key):
+    if _redis is not None:
+        try:
+            _redis.delete("post-mortem:" + key)
+        except redis.RedisError as e:
+            logger.warning(f"Redis cache delete failed: {str(e)}")
+        return
+    with _cache_lock, _cache_db:
+        _cache_db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+
+SYSTEM_PROMPT = "You are an expert post-mortem analyst."
+
+def _chunk(lines, B=CHUNK_SIZE):
+    """Yield (lines, text) for consecutive slices of at most B lines.
+
+    text is built once per chunk and numbers each line, so the LLM can cite
+    examples by index instead of repeating them.
+    """
+    for i in range(0, len(lines), B):
+        chunk_lines = lines[i:i + B]
+        yield chunk_lines, '\n'.join(f"{j}. {line}" for j, line in enumerate(chunk_lines))
+
+def _normalize_line(line):
+    """Case- and whitespace-insensitive form used to match duplicate lines"""
+    return " ".join(line.lower().split())
+
+def _dedupe_lines(lines):
+    """Count each distinct non-blank line, treating case and whitespace variants as duplicates.
+
+    The first spelling seen is kept as the line sent to the LLM.
+    """
+    counts = Counter()
+    representatives = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        counts[representatives.setdefault(_normalize_line(line), line)] += 1
+    return counts
 
-def create_llm_prompt(lines):
-    """Create a prompt that explicitly asks for structured JSON"""
-    return f"""Analyze these post-mortem lessons and return ONLY a strict JSON object with exactly this structure:
-
-{{
-    "unrecoverable_lines": [
-        "line 1 with no meaning",
-        "line 2 with no meaning"
-    ],
-    "common_ideas": [
-        {{
-            "title": "specific theme title",
-            "overall_confidence": 80,
-            "examples": [
-                {{
-                    "text": "specific example text",
-                    "confidence": 75
-                }}
-            ]
-        }}
-    ],
-    "uncategorized_lines": [
-        "meaningful uncategorized line 1",
-        "meaningful uncategorized line 2"
-    ],
-    "summary": "concise summary text",
-    "observations": [
-        "key observation 1",
-        "key observation 2"
-    ],
-    "recommendations": [
-        "recommendation 1",
-        "recommendation 2"
-    ]
-}}
-
-Replace all example text with your actual analysis.
-Important instructions:
-- "confidence" values must be integers between 0-100
-- All JSON arrays and objects must be properly formatted
-- Make sure all quotes are properly escaped within strings
-- DO NOT include any text, comments, or code blocks outside of the JSON structure
-- Do NOT use markdown code blocks - return just the raw JSON object
-- Include all required fields exactly as shown
-
-Here are the post-mortem lessons to analyze:
-
-{'\n'.join(lines)}
-
-Remember: Return ONLY the valid JSON object with no additional text before or after."""
-
-def extract_json_from_text(text):
-    """Attempt to extract JSON from text that might have additional content"""
-    # Try to find JSON-like pattern (starting with { and ending with })
-    json_pattern = r'(\{[\s\S]*\})$'  # Match the last occurrence of a JSON block
-    match = re.search(json_pattern, text)
-    if match:
-        return match.group(1)
-    return text
-
-@retry(
-    stop=stop_after_attempt(5),  # More retries
-    wait=wait_exponential(multiplier=1, min=4, max=30),  # Longer backoff
-    retry=retry_if_exception_type((APIError, APIConnectionError, RateLimitError, BadRequestError)),
+def _expand_duplicates(report, counts):
+    """Repeat unrecoverable and uncategorized lines as often as they appeared in the input"""
+    # Match on the normalized form, the LLM may echo a line with different case or spacing
+    normalized_counts = {_normalize_line(line): count for line, count in counts.items()}
+    expanded = dict(report)
+    for field in ("unrecoverable_lines", "uncategorized_lines"):
+        expanded[field] = [line for line in report[field]
+                           for _ in range(normalized_counts.get(_normalize_line(line), 1))]
+    return expanded
+
+def _trivial_report(counts):
+    """Build a report locally for inputs too small to be worth an LLM call"""
+    return {
+        "unrecoverable_lines": [],
+        "common_ideas": [],
+        "uncategorized_lines": [line for line, count in counts.items() for _ in range(count)],
+        "summary": "Too few entries to analyze.",
+        "observations": [],
+        "recommendations": []
+    }
+
+# The instructions never change, so they are built once; only the lessons vary per call
+_PROMPT_HEAD = """Analyze these post-mortem lessons. They may be one batch of a larger file; report only on the lines below.
+Return JSON: {unrec:[str], themes:[{t:str,c:int,ex:[{i:int,c:int}]}], uncat:[str], sum:str, obs:[str], rec:[str]}
+unrec: lines with no recoverable meaning. themes: common ideas, t=title, c=overall confidence 0-100, ex=example lines (i=line number, c=fit confidence 0-100).
+uncat: meaningful lines fitting no theme. Copy unrec and uncat lines without their number.
+sum: concise summary. obs: key observations. rec: recommendations.
+
+Lessons:
+"""
+
+def _local_report(counts):
+    """Return the report for input that needs no LLM call (empty or too small), else None"""
+    if not counts:
+        return {"error": "No input data provided"}
+    if len(counts) < MIN_LINES_FOR_LLM:
+        logger.info(f"Only {len(counts)} distinct line(s), skipping the LLM")
+        return _trivial_report(counts)
+    return None
+
+def quick_report(lines):
+    """Report for lines that don't need the LLM, or None if they should be analyzed"""
+    return _local_report(_dedupe_lines(lines))
+
+def create_llm_prompt(joined_chunk: str):
+    """Create a prompt for one already-joined chunk of lines, described against the short-key schema"""
+    return _PROMPT_HEAD + joined_chunk
+
+def _string_list():
+    return {"type": "array", "items": {"type": "string"}}
+
+# Schema enforced by the API via structured outputs, so responses are always valid JSON of this shape.
+# Keys are kept short to save output tokens; _expand_keys maps them back to the report fields.
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "unrec": _string_list(),
+        "themes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "t": {"type": "string"},
+                    "c": {"type": "integer"},
+                    "ex": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "i": {"type": "integer"},
+                                "c": {"type": "integer"}
+                            },
+                            "required": ["i", "c"],
+                            "additionalProperties": False
+                        }
+                    }
+                },
+                "required": ["t", "c", "ex"],
+                "additionalProperties": False
+            }
+        },
+        "uncat": _string_list(),
+        "sum": {"type": "string"},
+        "obs": _string_list(),
+        "rec": _string_list()
+    },
+    "required": ["unrec", "themes", "uncat", "sum", "obs", "rec"],
+    "additionalProperties": False
+}
+
+def _example_text(chunk_lines, index):
+    if not 0 <= index < len(chunk_lines):
+        raise ValueError(f"Example refers to unknown line {index}")
+    return chunk_lines[index]
+
+def _expand_keys(response, chunk_lines):
+    """Map a short-key LLM response onto the report structure used everywhere else.
+
+    Examples come back as line numbers and are resolved to the chunk's text here.
+    """
+    return {
+        "unrecoverable_lines": response["unrec"],
+        "common_ideas": [
+            {
+                "title": theme["t"],
+                "overall_confidence": theme["c"],
+                "examples": [
+                    {"text": _example_text(chunk_lines, example["i"]), "confidence": example["c"]}
+                    for example in theme["ex"]
+                ]
+            }
+            for theme in response["themes"]
+        ],
+        "uncategorized_lines": response["uncat"],
+        "summary": response["sum"],
+        "observations": response["obs"],
+        "recommendations": response["rec"]
+    }
+
+def build_chat_request(prompt, model=MODEL):
+    """Build the chat completion request body shared by the sync and batch paths"""
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": TEMPERATURE,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "post_mortem", "schema": RESPONSE_SCHEMA, "strict": True}
+        }
+    }
+
+# Retry policy applied to each chunk request
+RETRY_POLICY = dict(
+    stop=stop_after_attempt(5) | stop_after_delay(60),  # Bounded by attempts and total time
+    wait=wait_random_exponential(multiplier=1, max=30),  # Full jitter so sessions don't retry in lockstep
+    # Only transient failures; a 4xx request error would fail the same way again
+    retry=retry_if_exception_type((APIConnectionError, RateLimitError, InternalServerError)),
     reraise=True
 )
-def analyze_with_llm(prompt):
+
+async def analyze_with_llm(async_client, prompt, on_delta=None, model=MODEL):
     try:
-        logger.info(f"Using model: {MODEL}")
+        logger.info(f"Using model: {model}")
         
-        # Basic API call without response_format
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": "You are an expert post-mortem analyst. Return only valid, properly formatted JSON with the exact structure requested."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1,
+        # Stream the completion so callers can show the response while it is generated
+        stream = await async_client.chat.completions.create(
+            **build_chat_request(prompt, model),
+            stream=True,
             timeout=90  # Increased timeout
         )
-        return response.choices[0].message.content
+        parts = []
+        refusal_parts = []
+        finish_reason = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content:
+                parts.append(choice.delta.content)
+                if on_delta:
+                    on_delta(choice.delta.content)
+            # With strict structured outputs a refusal arrives here instead of in content
+            if getattr(choice.delta, "refusal", None):
+                refusal_parts.append(choice.delta.refusal)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+        
+        return "".join(parts), finish_reason, "".join(refusal_parts) or None
     except Exception as e:
         logger.error(f"API request failed: {str(e)}")
         raise
 
-def attempt_json_repair(text):
-    """Try to repair common JSON formatting issues"""
-    # Remove any code block markers
-    text = re.sub(r'```json|```', '', text).strip()
-    
-    # Extract just the JSON part
-    text = extract_json_from_text(text)
-    
-    # Fix common escape character issues
-    text = text.replace('\\"', '"')
-    text = text.replace('\\n', ' ')
-    
-    return text
-
 def validate_response_structure(parsed_result):
     """Ensure the response has the correct structure"""
     required_structure = {
@@ -158,42 +375,22 @@ def validate_response_structure(parsed_result):
             if not all(key in example for key in ["text", "confidence"]):
                 raise ValueError("Invalid example structure in common_ideas")
 
-def analyze_lessons(lines):
-    if not lines:
-        return {"error": "No input data provided"}
+def parse_analysis(result, chunk_lines):
+    """Turn a raw LLM response for one chunk into a validated report, or an error dict"""
+    # Log the raw response for debugging
+    logger.info(f"Raw LLM response (first 200 chars): {result[:200]}...")
     
     try:
-        prompt = create_llm_prompt(lines)
-        result = analyze_with_llm(prompt)
-        
-        # Log the raw response for debugging
-        logger.info(f"Raw LLM response (first 200 chars): {result[:200]}...")
-        
-        try:
-            # Clean the response
-            result = result.strip()
-            
-            # Remove code blocks if present
-            if result.startswith("```json") and result.endswith("```"):
-                result = result[7:-3].strip()
-            elif result.startswith("```") and result.endswith("```"):
-                result = result[3:-3].strip()
-                
-            # Try to parse the JSON
-            try:
-                parsed_result = json.loads(result)
-            except json.JSONDecodeError:
-                # If initial parsing fails, try to repair the JSON
-                logger.warning("Initial JSON parsing failed, attempting repair")
-                repaired_result = attempt_json_repair(result)
-                parsed_result = json.loads(repaired_result)
-                
-        except json.JSONDecodeError as e:
-            # Return more detailed error with the actual response for debugging
-            error_msg = f"Failed to parse JSON: {str(e)}. First 500 chars of response: {result[:500]}"
-            logger.error(error_msg)
-            return {"error": "The analysis response was malformed. Please try again.", 
-                    "debug_info": error_msg}
+        parsed_result = orjson.loads(result)
+    except orjson.JSONDecodeError as e:
+        # Return more detailed error with the actual response for debugging
+        error_msg = f"Failed to parse JSON: {str(e)}. First 500 chars of response: {result[:500]}"
+        logger.error(error_msg)
+        return {"error": "The analysis response was malformed. Please try again.", 
+                "debug_info": error_msg}
+    
+    try:
+        parsed_result = _expand_keys(parsed_result, chunk_lines)
         
         # Validate structure
         validate_response_structure(parsed_result)
@@ -203,12 +400,272 @@ def analyze_lessons(lines):
             idea["overall_confidence"] = int(idea["overall_confidence"])
             for example in idea["examples"]:
                 example["confidence"] = int(example["confidence"])
-        
-        return parsed_result
-        
-    except ValueError as e:
+    except (KeyError, ValueError, TypeError) as e:
         logger.error(f"Invalid response structure: {str(e)}")
         return {"error": f"Analysis failed: {str(e)}"}
+    
+    return parsed_result
+
+def _merge_reports(reports):
+    """Combine the partial reports of each chunk into a single report"""
+    if len(reports) == 1:
+        return reports[0]
+    
+    merged = {
+        "unrecoverable_lines": [],
+        "uncategorized_lines": [],
+        "observations": [],
+        "recommendations": []
+    }
+    ideas = {}
+    confidences = {}
+    summaries = []
+    
+    for report in reports:
+        for field in merged:
+            merged[field].extend(report[field])
+        # Themes with the same title across chunks are the same theme
+        for idea in report["common_ideas"]:
+            key = idea["title"].strip().lower()
+            if key not in ideas:
+                ideas[key] = {"title": idea["title"], "overall_confidence": 0, "examples": []}
+                confidences[key] = []
+            ideas[key]["examples"].extend(idea["examples"])
+            confidences[key].append(idea["overall_confidence"])
+        if report["summary"]:
+            summaries.append(report["summary"])
+    
+    for key, idea in ideas.items():
+        idea["overall_confidence"] = round(sum(confidences[key]) / len(confidences[key]))
+    
+    # Chunks often repeat the same observations and recommendations
+    merged["observations"] = list(dict.fromkeys(merged["observations"]))
+    merged["recommendations"] = list(dict.fromkeys(merged["recommendations"]))
+    merged["common_ideas"] = list(ideas.values())
+    merged["summary"] = " ".join(summaries)
+    return merged
+
+async def _complete_and_parse(async_client, semaphore, prompt, chunk_lines, on_delta, model):
+    key = _cache_key(prompt, model)
+    # Cache calls block (sqlite or Redis), so keep them off the event loop
+    result = await asyncio.to_thread(_cache_get, key)
+    if result is not None:
+        parsed_result = parse_analysis(result, chunk_lines)
+        if "error" not in parsed_result:
+            logger.info("Using cached LLM response")
+            if on_delta:
+                on_delta(result)
+            return parsed_result
+        # A stale entry the current parser rejects; evict it and ask the model again
+        logger.warning("Discarding cached LLM response that no longer parses")
+        await asyncio.to_thread(_cache_delete, key)
+    
+    async with semaphore:
+        async for attempt in AsyncRetrying(**RETRY_POLICY):
+            with attempt:
+                result, finish_reason, refusal = await analyze_with_llm(async_client, prompt, on_delta, model)
+    
+    if refusal:
+        logger.error(f"Model refused the request: {refusal}")
+        return {"error": "The model refused to analyze this file.", "debug_info": f"Refusal: {refusal}"}
+    
+    # Only a completed stream holds a full JSON document worth parsing; a
+    # truncated one is reported like any bad response so the chunk can escalate
+    if finish_reason != "stop":
+        error_msg = f"Response ended early (finish_reason: {finish_reason}). First 500 chars: {result[:500]}"
+        logger.error(error_msg)
+        return {"error": "The analysis response was incomplete. Please try again.", "debug_info": error_msg}
+    
+    parsed_result = parse_analysis(result, chunk_lines)
+    # Never cache a bad response, or the same failure would be replayed forever
+    if "error" not in parsed_result:
+        await asyncio.to_thread(_cache_set, key, result)
+    return parsed_result
+
+async def _analyze_chunk(async_client, semaphore, chunk, on_delta=None):
+    chunk_lines, text = chunk
+    prompt = create_llm_prompt(text)
+    parsed_result = await _complete_and_parse(async_client, semaphore, prompt, chunk_lines, on_delta, MODEL)
+    # The small default model handles most chunks; only retry failures on the larger one
+    if "error" in parsed_result and MODEL_ESCALATE != MODEL:
+        logger.warning(f"Escalating chunk to {MODEL_ESCALATE} (escalation #{next(_escalation_count)}): "
+                       f"{parsed_result['error']}")
+        parsed_result = await _complete_and_parse(async_client, semaphore, prompt, chunk_lines, on_delta,
+                                                  MODEL_ESCALATE)
+    return parsed_result
+
+async def _run_all(chunks, concurrency=MAX_CONCURRENCY, on_progress=None):
+    """Analyze all (lines, text) chunks concurrently, at most `concurrency` requests in flight.
+
+    on_progress, if given, is called as on_progress(chunk_index, text) for every
+    streamed piece of each chunk's response.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    # A fresh client per run, since asyncio.run closes the event loop it was bound to
+    async with openai.AsyncOpenAI(api_key=API_KEY) as async_client:
+        return await asyncio.gather(*[
+            _analyze_chunk(async_client, semaphore, chunk,
+                           (lambda delta, i=i: on_progress(i, delta)) if on_progress else None)
+            for i, chunk in enumerate(chunks)
+        ])
+
+def _load_partial(key):
+    """Return the cached partial report for a chunk, or None if missing or unusable"""
+    partial = _cache_get(key)
+    if partial is None:
+        return None
+    try:
+        partial = orjson.loads(partial)
+        validate_response_structure(partial)
+        return partial
+    except (orjson.JSONDecodeError, ValueError, TypeError):
+        logger.warning("Discarding cached partial report that no longer validates")
+        _cache_delete(key)
+        return None
+
+def analyze_lessons(lines, on_progress=None):
+    """Analyze an iterable of lines; it is consumed once and never held in full"""
+    try:
+        # Repeated lines (boilerplate, duplicate entries) are only sent to the LLM once
+        counts = _dedupe_lines(lines)
+        report = _local_report(counts)
+        if report is not None:
+            return report
+        unique_lines = list(counts)
+        
+        chunks = list(_chunk(unique_lines))
+        keys = [_chunk_key(text) for _, text in chunks]
+        
+        # Re-uploads of an edited file only re-analyze the chunks that changed
+        partials = [_load_partial(key) for key in keys]
+        missing = [i for i, partial in enumerate(partials) if partial is None]
+        logger.info(f"Analyzing {len(unique_lines)} unique of {sum(counts.values())} lines "
+                    f"in {len(chunks)} chunk(s), {len(chunks) - len(missing)} cached")
+        
+        if missing:
+            fresh = asyncio.run(_run_all(
+                [chunks[i] for i in missing],
+                on_progress=(lambda i, delta: on_progress(missing[i], delta)) if on_progress else None
+            ))
+            for i, partial in zip(missing, fresh):
+                if "error" in partial:
+                    return partial
+                _cache_set(keys[i], orjson.dumps(partial).decode("utf-8"))
+                partials[i] = partial
+        
+        return _expand_duplicates(_merge_reports(partials), counts)
     except Exception as e:
         logger.error(f"Analysis failed: {str(e)}")
-        return {"error": f"An unexpected error occurred: {str(e)}"}
\ No newline at end of file
+        return {"error": f"An unexpected error occurred: {str(e)}"}
+
+def analyze_lessons_batch(list_of_file_contents):
+    """Submit one analysis request per file chunk to the OpenAI Batch API and return the batch id.
+
+    Batch jobs cost roughly half as much as synchronous calls but may take up to
+    24 hours to complete, so results are collected later with get_batch_results.
+    """
+    # Each file may be any iterable of lines, e.g. a lazy reader over the upload
+    file_counts = [_dedupe_lines(lines) for lines in list_of_file_contents]
+    if not file_counts:
+        raise ValueError("No input data provided")
+    
+    requests = []
+    chunk_counts = []
+    for i, counts in enumerate(file_counts):
+        # Files reported locally get no requests; get_batch_results rebuilds their report
+        chunks = list(_chunk(list(counts))) if _local_report(counts) is None else []
+        chunk_counts.append(str(len(chunks)))
+        for j, (_, text) in enumerate(chunks):
+            requests.append(orjson.dumps({
+                "custom_id": f"file-{i}-chunk-{j}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_chat_request(create_llm_prompt(text))
+            }))
+    
+    if not requests:
+        raise ValueError("No file needs LLM analysis; use quick_report for these files")
+    
+    batch_file = client.files.create(
+        file=("post_mortem_batch.jsonl", b"\n".join(requests)),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        # Needed to regroup the chunk results per file once the batch completes
+        metadata={"chunk_counts": ",".join(chunk_counts)}
+    )
+    logger.info(f"Submitted batch {batch.id} with {len(requests)} request(s)")
+    return batch.id
+
+def _read_batch_output(output, responses):
+    """Collect each request's raw response, or an error dict, from a batch output or error file"""
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            error_msg = f"Batch request failed: {item.get('error') or response.get('body')}"
+            logger.error(error_msg)
+            responses[item["custom_id"]] = {"error": "The batch request for this file failed.",
+                                            "debug_info": error_msg}
+            continue
+        message = response["body"]["choices"][0]["message"]
+        # A strict json_schema refusal comes back as null content plus a refusal message
+        if message.get("refusal") or not isinstance(message.get("content"), str):
+            error_msg = f"Batch request refused: {message.get('refusal')}"
+            logger.error(error_msg)
+            responses[item["custom_id"]] = {"error": "The model refused to analyze this file.",
+                                            "debug_info": error_msg}
+            continue
+        responses[item["custom_id"]] = message["content"]
+
+def get_batch_results(batch_id, list_of_file_contents):
+    """Look up a submitted batch and return (status, reports).
+
+    reports is None while the batch is still running; otherwise it holds one
+    report (or error dict) per submitted file, in submission order. The
+    submitted file contents are needed again to resolve the examples, which
+    the LLM returns as line numbers, and to restore duplicate lines.
+    """
+    batch = client.batches.retrieve(batch_id)
+    if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+        return batch.status, None
+    
+    chunk_counts = [int(count) for count in batch.metadata["chunk_counts"].split(",")]
+    # Expired and cancelled batches still return whatever finished, and failed
+    # requests are listed in the error file rather than the output file
+    responses = {}
+    for output_file_id in (batch.output_file_id, batch.error_file_id):
+        if output_file_id:
+            _read_batch_output(client.files.content(output_file_id).text, responses)
+    if not responses:
+        logger.error(f"Batch {batch_id} ended with status {batch.status}")
+        return batch.status, [{"error": f"Batch analysis {batch.status}. Please try again."}] * len(chunk_counts)
+    if batch.status == "completed":
+        missing = {"error": "No result was returned for this file."}
+    else:
+        missing = {"error": f"Batch analysis {batch.status} before this file was processed. Please try again."}
+    
+    file_reports = []
+    for i, (count, lines) in enumerate(zip(chunk_counts, list_of_file_contents)):
+        counts = _dedupe_lines(lines)
+        report = _local_report(counts)
+        if report is not None and count == 0:
+            file_reports.append(report)
+            continue
+        chunks = list(_chunk(list(counts)))
+        if report is not None or len(chunks) != count:
+            file_reports.append({"error": "The file changed since the batch was submitted. Please resubmit it."})
+            continue
+        
+        partials = []
+        for j, (chunk_lines, _) in enumerate(chunks):
+            response = responses.get(f"file-{i}-chunk-{j}", missing)
+            partials.append(response if isinstance(response, dict) else parse_analysis(response, chunk_lines))
+        errors = [partial for partial in partials if "error" in partial]
+        file_reports.append(errors[0] if errors else _expand_duplicates(_merge_reports(partials), counts))
+    return batch.status, file_reports